@@ -0,0 +1,46 @@
+import os
+import logging
+import threading
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# sentence-transformers (and the numpy it pulls in) is an optional dependency: it is far too large
+# for the Vercel bundle, so when it isn't installed everything built on embeddings simply stays off.
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "sentence-transformers/all-MiniLM-L6-v2")
+
+_model = None
+_model_unavailable = False
+# embed() runs on the thread pool; without this a burst of first requests would each load a copy.
+_model_lock = threading.Lock()
+
+
+def _get_model():
+    global _model, _model_unavailable
+    if _model is None and not _model_unavailable:
+        with _model_lock:
+            if _model is None and not _model_unavailable:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                    _model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+                    logger.info(f"Loaded embedding model '{EMBEDDING_MODEL_NAME}'.")
+                except Exception as e:
+                    _model_unavailable = True
+                    logger.warning(f"Embeddings disabled, model could not be loaded: {e}")
+    return _model
+
+
+def embed(text: str):
+    """Returns a unit-length embedding for the normalized text, or None if no model is available."""
+    model = _get_model()
+    if model is None:
+        return None
+    return model.encode(text.strip().lower(), normalize_embeddings=True)
+
+
+def embed_many(texts):
+    """Embeds a list of texts in one pass, or returns None if no model is available."""
+    model = _get_model()
+    if model is None:
+        return None
+    return model.encode([text.strip().lower() for text in texts], normalize_embeddings=True)
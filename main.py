@@ -1,27 +1,139 @@
 import os
 import logging
-import json
-import uvicorn
-import requests
+import asyncio
+import hashlib
+import random
+import time
+import httpx
+import orjson
 import re
 import math # We need this to round up the seconds
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
-from typing import List, Dict
-
-import tools
+from cachetools import TLRUCache
+from aiolimiter import AsyncLimiter
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Dict, Optional, Tuple
 
+# Load .env before importing tools, which reads its API keys at import time.
 load_dotenv()
 
+import tools
+import embeddings
+import router
+import semantic_cache
+
 MODEL_NAME = os.getenv("GROQ_MODEL_NAME", "llama-3.1-8b-instant") 
 
+# Compiled once instead of going through re's internal cache on every 429.
+_RATELIMIT_RE = re.compile(r"Please try again in (\d+\.?\d*)s")
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Multi-Tool LLM Agent")
+# orjson is already a dependency, so let it serialize every JSON response too.
+app = FastAPI(title="Multi-Tool LLM Agent", default_response_class=ORJSONResponse)
+
+# --- Groq HTTP Client ---
+# One shared async client for every Groq call: keep-alive skips the TCP/TLS handshake on each turn,
+# and awaiting it frees the event loop to serve other users while Groq is generating.
+GROQ_CHAT_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# Request bodies are pre-serialized with orjson, so the content type is set here rather than by httpx.
+GROQ_HEADERS = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
+
+@app.on_event("startup")
+async def open_http_client():
+    if not GROQ_API_KEY:
+        logger.warning("GROQ_API_KEY is not set. Every LLM call will fail until it is configured.")
+    app.state.http = httpx.AsyncClient(
+        http2=True,
+        headers=GROQ_HEADERS,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        timeout=30.0,
+    )
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
+# --- Blocking Work ---
+# Tool SDKs, embeddings and the classifier block, so they run on a shared pool while the event loop keeps
+# serving other requests. Tool calls mostly wait on upstream APIs, so the pool is sized for I/O, not CPU.
+POOL_SIZE = min(32, ((os.cpu_count() or 1) + 4) * 2)
 
-# --- Agent Configuration (Tools and System Prompt are unchanged) ---
+@app.on_event("startup")
+async def open_thread_pool():
+    app.state.pool = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="agent-blocking")
+
+@app.on_event("shutdown")
+async def close_thread_pool():
+    app.state.pool.shutdown(wait=False, cancel_futures=True)
+
+async def run_blocking(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(app.state.pool, partial(func, *args, **kwargs))
+
+# --- Groq Retries and Rate Limiting ---
+# Throttled or flaky Groq calls are retried in-process with exponential backoff (or Groq's own
+# suggested wait) so the user doesn't have to resend. Bursts queue here instead of tripping the
+# per-model requests-per-minute limit in the first place.
+GROQ_MAX_RETRIES = 3
+GROQ_BACKOFF_FACTOR = 0.3
+GROQ_RETRY_STATUSES = {429, 500, 502, 503}
+# Longer waits are passed on to the user rather than holding the request open. The budget caps the
+# whole request (every attempt plus every wait), keeping it well inside a serverless function's timeout.
+GROQ_MAX_RETRY_WAIT = 10.0
+GROQ_RETRY_BUDGET = 15.0
+GROQ_LIMITER = AsyncLimiter(int(os.getenv("GROQ_REQUESTS_PER_MINUTE", 30)), 60)
+
+def retry_delay(response: httpx.Response, attempt: int) -> float:
+    retry_after = response.headers.get("retry-after")
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    match = _RATELIMIT_RE.search(response.text)
+    if match:
+        return float(match.group(1))
+    return GROQ_BACKOFF_FACTOR * (2 ** attempt) + random.uniform(0, GROQ_BACKOFF_FACTOR)
+
+@asynccontextmanager
+async def groq_request(payload: dict):
+    """Opens a streamed chat completion request, retrying throttled and transient failures first."""
+    content = orjson.dumps(payload)
+    started = time.monotonic()
+    timeout = httpx.USE_CLIENT_DEFAULT
+    for attempt in range(GROQ_MAX_RETRIES + 1):
+        async with GROQ_LIMITER:
+            request = app.state.http.build_request("POST", GROQ_CHAT_URL, content=content, timeout=timeout)
+            response = await app.state.http.send(request, stream=True)
+
+        if response.is_error:
+            # Load the body so the retry logic and the error handler can read Groq's error details.
+            await response.aread()
+            if response.status_code in GROQ_RETRY_STATUSES and attempt < GROQ_MAX_RETRIES:
+                delay = retry_delay(response, attempt)
+                elapsed = time.monotonic() - started
+                if delay <= GROQ_MAX_RETRY_WAIT and elapsed + delay <= GROQ_RETRY_BUDGET:
+                    logger.warning(f"Groq returned {response.status_code}. Retrying in {delay:.2f}s (attempt {attempt + 1}/{GROQ_MAX_RETRIES}).")
+                    await response.aclose()
+                    await asyncio.sleep(delay)
+                    # A retry only gets whatever is left of the budget, not a fresh client timeout.
+                    timeout = max(GROQ_RETRY_BUDGET - (time.monotonic() - started), 1.0)
+                    continue
+
+        try:
+            yield response
+        finally:
+            await response.aclose()
+        return
+
+# --- Agent Configuration (Tool Table, Groq Tool Schemas and Prompts) ---
 AVAILABLE_TOOLS = {
     "get_news": {
         "function": tools.get_news,
@@ -50,117 +162,297 @@ AVAILABLE_TOOLS = {
     }
 }
 
-SYSTEM_PROMPT = """
-You are a smart, tool-using assistant. Your goal is to accurately determine the user's intent and select the appropriate tool.
+# The router uses Groq's native tool calling, so the tools travel as function schemas instead of a
+# manifest pasted into a long prompt; the short system prompt keeps prefill to a minimum.
+ROUTER_SYSTEM_PROMPT = (
+    "You are a smart, tool-using assistant. Call a tool only when the user's latest query clearly and directly needs one.\n"
+    "For conversational follow-ups (\"why is that?\", \"tell me more\") or when no tool fits, reply without calling a tool."
+)
+
+# The tools never change after import, so their schemas are built once rather than per request.
+GROQ_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": props["description"],
+            "parameters": {"type": "object", "properties": props["args"], "required": list(props["args"])},
+        },
+    }
+    for name, props in AVAILABLE_TOOLS.items()
+]
+
+FALLBACK_SYSTEM_PROMPT = "You are a helpful and conversational assistant."
+
+def build_messages(system_prompt: str, history: List[Dict[str, str]], query: str) -> List[Dict[str, str]]:
+    """Lays out a chat request so its prefix is byte-identical from one request to the next."""
+    # Groq reuses its KV cache for a prompt prefix it has already seen, so the fixed system prompt goes
+    # first and the new query last. Never put per-request data (timestamps, IDs) in the system prompts.
+    # Only role and content reach the model; normalizing them keeps the same turn serializing the same way.
+    turns = [{"role": turn.get("role", "user"), "content": turn.get("content", "").strip()} for turn in history]
+    return [{"role": "system", "content": system_prompt}, *turns, {"role": "user", "content": query}]
+
+
+# --- Response Cache ---
+# Repeat queries skip both the Groq routing call and the tool call.
+# Each entry lives as long as the tool that produced it stays fresh.
+TOOL_CACHE_TTL = {
+    "get_weather": 600,
+    "get_wikipedia_summary": 86400,
+    "get_stock_price": 30,
+    "get_news": 300,
+    "calculator": 86400,
+    "fallback": 60,
+}
+
+RESPONSE_CACHE = TLRUCache(
+    maxsize=1024,
+    ttu=lambda key, entry, now: now + TOOL_CACHE_TTL.get(entry["tool_name"], 60),
+    timer=time.monotonic,
+)
 
-Here is your thought process:
-1.  First, analyze the entire conversation history to understand the context.
-2.  Second, focus on the user's **latest query** to identify their primary, immediate intent.
-3.  Compare this intent against the descriptions of the available tools.
+def history_fingerprint(history: List[Dict[str, str]]) -> str:
+    return hashlib.sha1(orjson.dumps(history, option=orjson.OPT_SORT_KEYS)).hexdigest()
 
-Your Rules:
-- If the user's latest query CLEARLY and DIRECTLY matches the description of a tool, you MUST choose that tool. For example, queries about 'weather', 'climate', or 'forecast' should always use the 'get_weather' tool.
-- If the query is a conversational follow-up that does not explicitly ask for a tool (e.g., "why is that?", "tell me more", "how?"), or if no tool is a good fit, you MUST use the 'fallback' tool to continue the conversation.
+def response_cache_key(query: str, history: List[Dict[str, str]]) -> str:
+    # Only whitespace is normalized: routing is case-sensitive ("price of IT" is a ticker, "price of it" isn't).
+    return f"{' '.join(query.split())}:{history_fingerprint(history)}"
 
-You must respond ONLY with a valid JSON object with 'tool_name' and 'arguments' keys.
+def cache_response(query: str, history: List[Dict[str, str]], tool_name: str, result: str) -> None:
+    RESPONSE_CACHE[response_cache_key(query, history)] = {"query": query, "result": result, "tool_name": tool_name}
 
-Here are the available tools:
-{tools_json}
-"""
+
+# Near-duplicate phrasings ("weather in NYC" / "what's the weather in New York City") reuse a cached
+# answer too, except for tools whose results go stale too quickly or depend on the exact input.
+SEMANTIC_CACHE = semantic_cache.SemanticCache(maxsize=1024)
+SEMANTIC_CACHE_TOOLS = {"get_weather", "get_wikipedia_summary", "get_news", "fallback"}
+
+
+# Characters a plain arithmetic query can start with, besides a digit.
+MATH_LEADING_CHARS = "(-+."
 
 
 class QueryRequest(BaseModel):
     query: str
     history: List[Dict[str, str]] = Field(default_factory=list)
 
-def is_purely_math_query(query: str) -> bool:
-    math_pattern = r"^[\d\s\+\-\*/\(\)\.]+$"
-    return bool(re.fullmatch(math_pattern, query.strip()))
+# Keeps a single batch from bursting through Groq's per-minute request limit.
+MAX_BATCH_SIZE = 10
 
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest] = Field(max_length=MAX_BATCH_SIZE)
 
-def orchestrate_agent(query: str, history: List[Dict[str, str]]) -> dict:
-    logger.info(f"Orchestrating with LLM ({MODEL_NAME}) for query: {query}")
-    llm_choice_str = "" 
+class GroqStreamError(Exception):
+    """An error event Groq sent in the middle of an otherwise successful (200) stream."""
 
+    def __init__(self, error: dict):
+        super().__init__(error.get("message", "unknown error"))
+        self.error = error
+
+def groq_error(body: bytes) -> dict:
+    """Returns the "error" object of a Groq error body, or {} if there isn't one."""
     try:
-        tools_json_string = json.dumps([{name: props['description'], 'args': props['args']} for name, props in AVAILABLE_TOOLS.items()], indent=2)
-        prompt_with_tools = SYSTEM_PROMPT.format(tools_json=tools_json_string)
-        
-        messages = [{"role": "system", "content": prompt_with_tools}] + history + [{"role": "user", "content": query}]
+        error = orjson.loads(body).get("error")
+    except (orjson.JSONDecodeError, AttributeError):
+        return {}
+    return error if isinstance(error, dict) else {}
+
+def parse_tool_arguments(arguments_str: str) -> Optional[dict]:
+    """Returns the tool call's arguments once their streamed JSON is complete."""
+    if not arguments_str.strip():
+        return None
+    try:
+        return orjson.loads(arguments_str)
+    except orjson.JSONDecodeError:
+        return None
 
-        response = requests.post(
-            "https://api.groq.com/openai/v1/chat/completions",
-            headers={"Authorization": f"Bearer {os.getenv('GROQ_API_KEY')}"},
-            json={ "model": MODEL_NAME, "messages": messages, "temperature": 0.0, "response_format": {"type": "json_object"} }
-        )
+
+async def choose_tool(query: str, history: List[Dict[str, str]]) -> Tuple[str, dict]:
+    """Asks the LLM which tool fits the latest query, returning as soon as the streamed decision is usable."""
+    messages = build_messages(ROUTER_SYSTEM_PROMPT, history, query)
+
+    payload = { "model": MODEL_NAME, "messages": messages, "temperature": 0.0, "tools": GROQ_TOOLS, "tool_choice": "auto", "stream": True }
+    tool_name, arguments_str = None, ""
+    async with groq_request(payload) as response:
+        # When the model produces a malformed tool call, Groq rejects it with "tool_use_failed", either
+        # up front as a 400 or as an error event mid-stream. Either way the conversational path can still answer.
+        if response.status_code == 400 and groq_error(response.content).get("code") == "tool_use_failed":
+            logger.warning("Groq rejected the model's tool call. Falling back to a direct answer.")
+            return "fallback", {}
         response.raise_for_status()
-        llm_choice_str = response.json()['choices'][0]['message']['content']
-        llm_choice = json.loads(llm_choice_str)
-        
-        tool_name = llm_choice.get("tool_name")
-        arguments = llm_choice.get("arguments", {})
 
-        logger.info(f"LLM chose tool: '{tool_name}' with arguments: {arguments}")
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            data = line[len("data: "):]
+            if data == "[DONE]":
+                break
+            event = orjson.loads(data)
+            if "error" in event:
+                if event["error"].get("code") == "tool_use_failed":
+                    logger.warning("Groq rejected the model's tool call mid-stream. Falling back to a direct answer.")
+                    return "fallback", {}
+                raise GroqStreamError(event["error"])
+            delta = event['choices'][0]['delta']
+
+            # Text instead of a tool call means no tool fits, so there is no reason to read the rest.
+            if delta.get('content') and tool_name is None:
+                return "fallback", {}
+
+            for tool_call in delta.get('tool_calls') or []:
+                if tool_call.get('index', 0) != 0:
+                    continue
+                function = tool_call.get('function', {})
+                tool_name = function.get('name') or tool_name
+                arguments_str += function.get('arguments') or ""
+
+            if tool_name:
+                arguments = parse_tool_arguments(arguments_str)
+                if arguments is not None:
+                    return tool_name, arguments
+
+    if tool_name is None:
+        return "fallback", {}
+    return tool_name, parse_tool_arguments(arguments_str) or {}
+
+
+async def run_tool(tool_name: str, arguments: dict) -> str:
+    return await run_blocking(AVAILABLE_TOOLS[tool_name]["function"], **arguments)
+
+
+def friendly_api_error(error_details: dict) -> Optional[str]:
+    """Explains a Groq error the user can act on, or returns None for anything else."""
+    if error_details.get("code") != "rate_limit_exceeded":
+        return None
+    # Use regex to find the wait time
+    match = _RATELIMIT_RE.search(error_details.get("message", ""))
+    if match:
+        wait_time = math.ceil(float(match.group(1)))
+        return f"It looks like I'm a bit popular right now! Please wait about {wait_time} seconds and try again."
+    return "I'm experiencing high traffic right now. Please try again in a moment."
+
+
+async def orchestrate_agent(query: str, history: List[Dict[str, str]], query_vector=None) -> dict:
+    logger.info(f"Orchestrating with LLM ({MODEL_NAME}) for query: {query}")
+
+    try:
+        # The first classifier call embeds the tool examples, so keep it off the event loop.
+        route = await run_blocking(router.local_route, query, history, query_vector)
+        if route:
+            tool_name, arguments = route
+            logger.info(f"Routed locally to tool: '{tool_name}' with arguments: {arguments}")
+        else:
+            tool_name, arguments = await choose_tool(query, history)
+            logger.info(f"LLM chose tool: '{tool_name}' with arguments: {arguments}")
 
         if tool_name in AVAILABLE_TOOLS:
-            result = AVAILABLE_TOOLS[tool_name]["function"](**arguments)
+            try:
+                result = await run_tool(tool_name, arguments)
+            except tools.ToolError as e:
+                # Failures are shown to the user but never cached, so the next request retries upstream.
+                return {"query": query, "result": str(e)}
+            cache_response(query, history, tool_name, result)
             return {"query": query, "result": result}
         
         elif tool_name == "fallback":
             logger.info("No suitable tool found. Falling back to direct LLM call.")
-            fallback_messages = [{"role": "system", "content": "You are a helpful and conversational assistant."}] + history + [{"role": "user", "content": query}]
+            fallback_messages = build_messages(FALLBACK_SYSTEM_PROMPT, history, query)
             direct_response_payload = { "model": MODEL_NAME, "messages": fallback_messages }
-            direct_response = requests.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={"Authorization": f"Bearer {os.getenv('GROQ_API_KEY')}"},
-                json=direct_response_payload
-            )
-            direct_response.raise_for_status()
-            return {"query": query, "result": direct_response.json()['choices'][0]['message']['content']}
+            async with groq_request(direct_response_payload) as direct_response:
+                direct_response.raise_for_status()
+                result = orjson.loads(await direct_response.aread())['choices'][0]['message']['content']
+            cache_response(query, history, tool_name, result)
+            return {"query": query, "result": result}
         
         else:
             return {"query": query, "result": f"Error: The LLM chose a tool ('{tool_name}') that does not exist."}
     
     # --- THE FIX IS HERE ---
-    # This is our new, smart error handler.
-    except requests.exceptions.HTTPError as e:
+    # This is our new, smart error handler. By now groq_request has already retried what it could.
+    except httpx.HTTPStatusError as e:
         logger.error(f"HTTP Error from LLM: {e.response.text}")
-        try:
-            # Try to parse the JSON error from the API
-            error_details = e.response.json().get("error", {})
-            error_code = error_details.get("code")
-
-            if error_code == "rate_limit_exceeded":
-                message = error_details.get("message", "")
-                # Use regex to find the wait time
-                match = re.search(r"Please try again in (\d+\.?\d*)s", message)
-                if match:
-                    wait_time = math.ceil(float(match.group(1)))
-                    friendly_message = f"It looks like I'm a bit popular right now! Please wait about {wait_time} seconds and try again."
-                    return {"query": query, "result": friendly_message}
-                else:
-                    return {"query": query, "result": "I'm experiencing high traffic right now. Please try again in a moment."}
-        except (json.JSONDecodeError, AttributeError):
-            # If the error isn't the JSON we expect, give a generic but clean message
-            return {"query": query, "result": f"An API error occurred (Status Code: {e.response.status_code})."}
+        # Try to parse the JSON error from the API
+        friendly_message = friendly_api_error(groq_error(e.response.content))
+        if friendly_message:
+            return {"query": query, "result": friendly_message}
+        # If the error isn't a rate limit we can explain, give a generic but clean message
+        return {"query": query, "result": f"An API error occurred (Status Code: {e.response.status_code})."}
+
+    except GroqStreamError as e:
+        logger.error(f"Error event in LLM stream: {e.error}")
+        friendly_message = friendly_api_error(e.error)
+        if friendly_message:
+            return {"query": query, "result": friendly_message}
+        return {"query": query, "result": f"An API error occurred ({e.error.get('code') or e.error.get('type') or 'unknown error'})."}
             
     except Exception as e:
         logger.error(f"An unexpected error occurred: {e}", exc_info=True)
         return {"query": query, "result": f"An unexpected error occurred in the agent logic: {e}"}
 
 
+async def answer_query(query: str, history: List[Dict[str, str]]) -> dict:
+    """Answers one query, trying the caches and the calculator before the LLM agent."""
+    query = query.strip()
+    logger.info(f"Received query: '{query}' with history length: {len(history)}")
+
+    cache_key = response_cache_key(query, history)
+    cached = RESPONSE_CACHE.get(cache_key)
+    if cached:
+        logger.info(f"Cache hit for query (tool: '{cached['tool_name']}'). Skipping LLM and tool calls.")
+        return {"query": query, "result": cached["result"]}
+
+    # A one-character check keeps the regex off the (common) non-math path. The calculator does
+    # the real validation and returns None for anything that isn't plain arithmetic.
+    if query[:1].isdigit() or query[:1] in MATH_LEADING_CHARS:
+        try:
+            result = await run_blocking(tools.try_calculate, query)
+        except tools.ToolError as e:
+            return {"query": query, "result": str(e)}
+        if result is not None:
+            logger.info("Math intent detected. Bypassing LLM and using calculator tool directly.")
+            return {"query": query, "result": result}
+
+    history_key = history_fingerprint(history)
+    try:
+        query_vector = await run_blocking(embeddings.embed, query)
+    except Exception as e:
+        # Embeddings only speed things up; without a vector the query still goes through the LLM router.
+        logger.warning(f"Embedding failed, skipping the semantic cache and classifier: {e}")
+        query_vector = None
+    if query_vector is not None:
+        similar = SEMANTIC_CACHE.get(query_vector, history_key)
+        if similar:
+            logger.info(f"Semantic cache hit on '{similar['query']}' (tool: '{similar['tool_name']}'). Skipping LLM and tool calls.")
+            return {"query": query, "result": similar["result"]}
+
+    response = await orchestrate_agent(query, history, query_vector)
+
+    # orchestrate_agent caches only real successes (tool failures raise ToolError), so that entry is what gets indexed.
+    entry = RESPONSE_CACHE.get(cache_key)
+    if query_vector is not None and entry and entry["tool_name"] in SEMANTIC_CACHE_TOOLS:
+        SEMANTIC_CACHE.put(query_vector, history_key, entry, TOOL_CACHE_TTL[entry["tool_name"]])
+    return response
+
+
 @app.post("/orchestrate")
 async def orchestrate(request: QueryRequest):
-    query = request.query.strip()
-    history = request.history
-    logger.info(f"Received query: '{query}' with history length: {len(history)}")
+    return await answer_query(request.query, request.history)
+
+
+@app.post("/orchestrate_batch")
+async def orchestrate_batch(request: BatchQueryRequest):
+    # Queries run concurrently over the shared client, so the batch costs roughly one round-trip, not one per query.
+    logger.info(f"Received batch of {len(request.queries)} queries")
+    answers = await asyncio.gather(*[answer_query(q.query, q.history) for q in request.queries], return_exceptions=True)
 
-    if is_purely_math_query(query):
-        logger.info("Math intent detected. Bypassing LLM and using calculator tool directly.")
-        result = tools.calculator(expression=query)
-        return {"query": query, "result": result}
-    else:
-        return orchestrate_agent(query, history)
+    # One failing query gets an error result of its own instead of turning the whole batch into a 500.
+    results = []
+    for q, answer in zip(request.queries, answers):
+        if isinstance(answer, Exception):
+            logger.error(f"Batch query '{q.query}' failed: {answer}", exc_info=answer)
+            answer = {"query": q.query.strip(), "result": f"An unexpected error occurred in the agent logic: {answer}"}
+        results.append(answer)
+    return {"results": results}
 
 # --- Local Development Setup ---
 if os.getenv("VERCEL") != "1":
@@ -168,6 +460,7 @@ if os.getenv("VERCEL") != "1":
     app.mount("/", StaticFiles(directory="public", html=True), name="static")
 
 if __name__ == "__main__":
+    import uvicorn
     port = int(os.getenv("PORT", 8000))
     uvicorn.run("main:app", host="0.0.0.0", port=port, reload=True)
 
@@ -0,0 +1,140 @@
+import logging
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import embeddings
+
+# Set up logging
+logger = logging.getLogger(__name__)
+
+# Trailing time words ("today", "right now") aren't part of a city name.
+_TIME_SUFFIX = r"(?:\s+(?:today|tonight|tomorrow|right now|now))?"
+
+# --- Fast Routes ---
+# Unambiguous phrasings map straight to a tool without asking the LLM router, so they must
+# only match when the argument is certain; anything looser is left to the LLM.
+FAST_ROUTES = [
+    ("get_weather", "city", re.compile(r"\bweather\s+(?:in|for|at)\s+(.+?)" + _TIME_SUFFIX + r"[\s?.!]*$", re.IGNORECASE)),
+    # A "$TICKER" is explicit; otherwise the ticker must end the query ("best stock for AI chips" isn't a quote).
+    ("get_stock_price", "ticker_symbol", re.compile(r"\b(?:stock\s+(?:price\s+)?|price\s+)(?:of\s+|for\s+)?\$([A-Z]{1,5})\b")),
+    ("get_stock_price", "ticker_symbol", re.compile(r"\b(?:stock\s+(?:price\s+)?|price\s+)(?:of\s+|for\s+)?([A-Z]{1,5})[\s?.!]*$")),
+]
+
+def fast_route(query: str) -> Optional[Tuple[str, dict]]:
+    for tool_name, arg_name, pattern in FAST_ROUTES:
+        match = pattern.search(query)
+        if match:
+            return tool_name, {arg_name: match.group(1).strip()}
+    return None
+
+
+# --- Local Classifier ---
+# Each tool is represented by a few example queries; a new query goes to the tool of its nearest
+# example. Below this cosine similarity the choice is left to the LLM router.
+CONFIDENCE_THRESHOLD = 0.55
+
+TOOL_EXAMPLES = {
+    "get_weather": [
+        "what's the weather like in London",
+        "is it going to rain in Seattle today",
+        "forecast for Tokyo",
+        "how hot is it in Dubai right now",
+        "current temperature in Paris",
+    ],
+    "get_stock_price": [
+        "stock price of AAPL",
+        "how is TSLA trading today",
+        "MSFT share price",
+        "what is NVDA at right now",
+    ],
+    "get_news": [
+        "latest news about Tesla",
+        "recent headlines on the election",
+        "what's in the news about climate change",
+        "any news on OpenAI",
+    ],
+    "get_wikipedia_summary": [
+        "what is Python",
+        "who was Albert Einstein",
+        "tell me about the Roman Empire",
+        "explain photosynthesis",
+    ],
+    "fallback": [
+        "hi there",
+        "thanks, that's helpful!",
+        "how are you doing",
+        "can you help me write a poem",
+    ],
+}
+
+# Pull the tool arguments out of the query; a classified query whose argument can't be found goes to the LLM.
+ARGUMENT_PATTERNS = {
+    "get_weather": ("city", re.compile(r"\b(?:in|for|at)\s+(.+?)" + _TIME_SUFFIX + r"[\s?.!]*$", re.IGNORECASE)),
+    "get_stock_price": ("ticker_symbol", re.compile(r"\$?\b([A-Z]{2,5})\b")),
+    "get_news": ("topic", re.compile(r"\b(?:news|headlines)\s+(?:about|on|for|regarding)\s+(.+?)[\s?.!]*$", re.IGNORECASE)),
+    "get_wikipedia_summary": ("search_term", re.compile(r"^(?:(?:what|who)\s+(?:is|was|are|were)\s+(?:an?\s+)?|tell me about\s+|explain\s+)(.+?)[\s?.!]*$", re.IGNORECASE)),
+}
+
+_prototypes = None
+_labels: List[str] = []
+_prototypes_lock = threading.Lock()
+
+
+def _get_prototypes():
+    """Embeds the tool examples once, the first time the classifier runs."""
+    global _prototypes, _labels
+    if _prototypes is None:
+        with _prototypes_lock:
+            if _prototypes is None:
+                texts = [example for examples in TOOL_EXAMPLES.values() for example in examples]
+                prototypes = embeddings.embed_many(texts)
+                # classify() reads _labels as soon as it sees _prototypes set, so publish the labels first.
+                _labels = [tool_name for tool_name, examples in TOOL_EXAMPLES.items() for _ in examples]
+                _prototypes = prototypes
+    return _prototypes
+
+
+def classify(query_vector) -> Optional[Tuple[str, float]]:
+    """Returns the nearest tool and its similarity score, or None if no embedding model is available."""
+    prototypes = _get_prototypes()
+    if prototypes is None:
+        return None
+    scores = prototypes @ query_vector
+    best = int(scores.argmax())
+    return _labels[best], float(scores[best])
+
+
+def extract_arguments(tool_name: str, query: str) -> Optional[Dict[str, str]]:
+    if tool_name == "fallback":
+        return {}
+    arg_name, pattern = ARGUMENT_PATTERNS[tool_name]
+    match = pattern.search(query)
+    if not match:
+        return None
+    return {arg_name: match.group(1).strip()}
+
+
+def local_route(query: str, history: List[Dict[str, str]], query_vector) -> Optional[Tuple[str, dict]]:
+    """Routes the query without the LLM when the regexes or the classifier are confident enough."""
+    route = fast_route(query)
+    if route:
+        return route
+
+    # Follow-ups like "and in Paris?" or "who is he?" depend on the conversation, which only the LLM sees.
+    if query_vector is None or history:
+        return None
+
+    prediction = classify(query_vector)
+    if prediction is None:
+        return None
+    tool_name, score = prediction
+    if score < CONFIDENCE_THRESHOLD:
+        logger.info(f"Classifier is unsure (best: '{tool_name}' at {score:.2f}). Deferring to the LLM router.")
+        return None
+
+    arguments = extract_arguments(tool_name, query)
+    if arguments is None:
+        logger.info(f"Classifier chose '{tool_name}' ({score:.2f}) but found no arguments. Deferring to the LLM router.")
+        return None
+    return tool_name, arguments
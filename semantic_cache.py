@@ -0,0 +1,45 @@
+import time
+from typing import Dict, List, Optional
+
+# A cached answer is reused when its query is within this cosine distance of the new one.
+MAX_COSINE_DISTANCE = 0.05
+
+# How many nearest neighbours to check for one that is fresh and shares the conversation history.
+_CANDIDATES = 5
+
+
+class SemanticCache:
+    """A fixed-size ring buffer of query embeddings searched by brute-force cosine similarity."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._vectors = None
+        self._entries: List[Optional[Dict]] = [None] * maxsize
+        self._next = 0
+
+    def get(self, vector, history_key: str) -> Optional[Dict]:
+        if self._vectors is None:
+            return None
+
+        import numpy as np
+
+        scores = self._vectors @ vector
+        now = time.monotonic()
+        for idx in np.argsort(-scores)[:_CANDIDATES]:
+            slot = self._entries[idx]
+            if slot is None or 1 - scores[idx] >= MAX_COSINE_DISTANCE:
+                break
+            if slot["history_key"] == history_key and slot["expires_at"] > now:
+                return slot["entry"]
+        return None
+
+    def put(self, vector, history_key: str, entry: Dict, ttl: float) -> None:
+        import numpy as np
+
+        if self._vectors is None:
+            self._vectors = np.zeros((self.maxsize, vector.shape[0]), dtype=vector.dtype)
+
+        # Overwrite the oldest slot once the buffer is full.
+        self._vectors[self._next] = vector
+        self._entries[self._next] = {"history_key": history_key, "entry": entry, "expires_at": time.monotonic() + ttl}
+        self._next = (self._next + 1) % self.maxsize
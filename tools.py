@@ -1,86 +1,223 @@
 import os
 import logging
 import re
-import wikipedia
-from newsapi import NewsApiClient
-from alpha_vantage.timeseries import TimeSeries
-import openmeteo_requests
-import requests_cache
-from retry_requests import retry
+import ast
+import operator
+import math
+import threading
+from functools import lru_cache
+from typing import Optional
+from cachetools import TTLCache, cached
 import requests
+from requests.adapters import HTTPAdapter
 
 # Set up logging
 logger = logging.getLogger(__name__)
 
+
+class ToolError(Exception):
+    """A tool call failed. The message is safe to show the user but must never be cached as an answer."""
+
+# Shared session for the geocoding lookups so repeated weather queries reuse the connection.
+GEO_SESSION = requests.Session()
+GEO_SESSION.mount("https://geocoding-api.open-meteo.com", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# API keys are read once at import instead of on every tool call.
+_NEWS_KEY = os.getenv("NEWS_API_KEY")
+_AV_KEY = os.getenv("ALPHA_VANTAGE_API_KEY")
+
+# --- Tool SDK Clients ---
+# The tool SDKs are imported on first use rather than at module load, which keeps
+# cold starts fast and skips the import entirely for tools a worker never runs.
+_NEWS = None
+_TS = None
+_WEATHER_SESSION = None
+_OPENMETEO = None
+
+def _newsapi():
+    global _NEWS
+    if _NEWS is None:
+        from newsapi import NewsApiClient
+        _NEWS = NewsApiClient(api_key=_NEWS_KEY)
+    return _NEWS
+
+def _timeseries():
+    global _TS
+    if _TS is None:
+        from alpha_vantage.timeseries import TimeSeries
+        _TS = TimeSeries(key=_AV_KEY, output_format='json')
+    return _TS
+
+def _weather_session():
+    # An on-disk SQLite cache in /tmp is thrown away on every Vercel cold start anyway,
+    # so the forecast cache lives in memory and skips the SQLite read/write on each call.
+    global _WEATHER_SESSION
+    if _WEATHER_SESSION is None:
+        import requests_cache
+        from retry_requests import retry
+        cache_session = requests_cache.CachedSession(backend='memory', expire_after=3600)
+        _WEATHER_SESSION = retry(cache_session, retries=5, backoff_factor=0.2)
+    return _WEATHER_SESSION
+
+def _openmeteo():
+    global _OPENMETEO
+    if _OPENMETEO is None:
+        import openmeteo_requests
+        _OPENMETEO = openmeteo_requests.Client(session=_weather_session())
+    return _OPENMETEO
+
+# --- Cached Remote Fetches ---
+# Popular tickers, topics and pages are asked for over and over, so each upstream
+# result is reused for as long as that kind of data stays fresh.
+STOCK_TTL = 30
+NEWS_TTL = 300
+WIKIPEDIA_TTL = 86400
+GEOCODE_TTL = 3600
+
+@cached(TTLCache(maxsize=256, ttl=STOCK_TTL), lock=threading.Lock())
+def _fetch_quote(ticker_symbol: str) -> dict:
+    data, meta_data = _timeseries().get_quote_endpoint(symbol=ticker_symbol)
+    logger.info(f"Alpha Vantage raw data for {ticker_symbol}: {data}")
+
+    # Raising keeps empty replies and rate-limit notes out of the cache.
+    if not data:
+        raise ToolError(f"No data returned from the stock API for '{ticker_symbol}'. This could be due to an invalid ticker or API rate limits.")
+    if not data.get('05. price'):
+        error_note = data.get('Note')
+        if error_note:
+            raise ToolError(f"Stock API error for '{ticker_symbol}': {error_note}")
+        raise ToolError(f"Could not find the price in the API response for '{ticker_symbol}'.")
+    return data
+
+@cached(TTLCache(maxsize=256, ttl=NEWS_TTL), lock=threading.Lock())
+def _fetch_articles(topic: str) -> list:
+    all_articles = _newsapi().get_everything(q=topic, language='en', sort_by='relevancy', page_size=3)
+    return all_articles.get('articles', [])
+
+@cached(TTLCache(maxsize=256, ttl=WIKIPEDIA_TTL), lock=threading.Lock())
+def _fetch_summary(search_term: str) -> str:
+    import wikipedia
+    return wikipedia.summary(search_term, sentences=2, auto_suggest=False)
+
+@cached(TTLCache(maxsize=256, ttl=GEOCODE_TTL), lock=threading.Lock())
+def _geocode(city: str) -> dict:
+    geocoding_url = "https://geocoding-api.open-meteo.com/v1/search"
+    geocoding_params = {"name": city, "count": 1, "language": "en", "format": "json"}
+
+    geo_response = GEO_SESSION.get(geocoding_url, params=geocoding_params)
+    geo_response.raise_for_status()
+
+    geo_data = geo_response.json()
+    logger.info(f"Geocoding API response for '{city}': {geo_data}")
+
+    results = geo_data.get("results")
+    if not results:
+        # Raising keeps a misspelled or mis-parsed city from being cached as "not found".
+        logger.warning(f"Geocoding failed for city '{city}'. No 'results' key in response.")
+        raise ToolError(f"Could not find a location for '{city}'. Please provide a more specific name or check for typos.")
+    return results[0]
+
+# --- Calculator Internals ---
+_SAFE_EXPR_RE = re.compile(r'^[\d\s\+\-\*/\(\)\.]+$')
+
+_SAFE_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+# Keeps a short expression like '(10**1000)**1000' from turning into a huge computation:
+# any intermediate integer result larger than this many bits is rejected before it is computed.
+_MAX_RESULT_BITS = 4096
+
+def _check_result_size(op: ast.operator, left, right) -> None:
+    if not (isinstance(left, int) and isinstance(right, int)):
+        # Float arithmetic can't grow without bound; it overflows to an error instead.
+        return
+    if isinstance(op, ast.Pow):
+        estimated_bits = right * math.log2(abs(left)) if right > 0 and abs(left) > 1 else 0
+    elif isinstance(op, ast.Mult):
+        estimated_bits = abs(left).bit_length() + abs(right).bit_length()
+    else:
+        return
+    if estimated_bits > _MAX_RESULT_BITS:
+        raise ValueError("Result is too large to calculate.")
+
+@lru_cache(maxsize=512)
+def _parse(expression: str) -> ast.Expression:
+    return ast.parse(expression, mode='eval')
+
+def _eval(node: ast.AST):
+    """Walks an arithmetic AST, allowing only numbers and the operators in _SAFE_OPS."""
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+        return node.value
+    if isinstance(node, ast.BinOp) and type(node.op) in _SAFE_OPS:
+        left, right = _eval(node.left), _eval(node.right)
+        _check_result_size(node.op, left, right)
+        return _SAFE_OPS[type(node.op)](left, right)
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _SAFE_OPS:
+        return _SAFE_OPS[type(node.op)](_eval(node.operand))
+    raise ValueError(f"Unsupported expression element: {type(node).__name__}")
+
 # --- Tool Functions ---
 
-def calculator(expression: str) -> str:
-    """Evaluates simple, safe math expressions."""
+def try_calculate(expression: str) -> Optional[str]:
+    """Evaluates the expression if it is plain arithmetic, or returns None if it isn't math at all."""
+    if not _SAFE_EXPR_RE.match(expression):
+        return None
     try:
-        if re.match(r'^[\d\s\+\-\*/\(\)\.]+$', expression):
-            return str(eval(expression))
-        else:
-            return "Invalid math expression. Only numbers and basic operators are allowed."
+        return str(_eval(_parse(expression.strip()).body))
     except Exception as e:
         logger.error(f"Calculator error: {e}")
-        return "Calculation failed. Check the math expression."
+        raise ToolError("Calculation failed. Check the math expression.") from e
+
+def calculator(expression: str) -> str:
+    """Evaluates simple, safe math expressions."""
+    result = try_calculate(expression)
+    if result is None:
+        raise ToolError("Invalid math expression. Only numbers and basic operators are allowed.")
+    return result
 
 def get_news(topic: str) -> str:
     """Fetches recent news articles about a specific topic."""
     try:
-        newsapi = NewsApiClient(api_key=os.getenv("NEWS_API_KEY"))
-        all_articles = newsapi.get_everything(q=topic, language='en', sort_by='relevancy', page_size=3)
-        
-        articles = all_articles.get('articles', [])
+        articles = _fetch_articles(topic)
         if not articles:
-            return f"No recent news found for '{topic}'."
+            raise ToolError(f"No recent news found for '{topic}'.")
         
         summary = f"Here are the top headlines for '{topic}':\n"
         for article in articles:
             summary += f"- {article['title']}: {article.get('description', 'No description available.')}\n"
         return summary
+    except ToolError:
+        raise
     except Exception as e:
         logger.error(f"News API error: {e}")
-        return f"Error fetching news: {str(e)}"
+        raise ToolError(f"Error fetching news: {str(e)}") from e
 
 def get_weather(city: str) -> str:
     """Provides the current weather conditions for a given city."""
     try:
         # --- STEP 1: Geocoding (Robust version) ---
-        geocoding_url = "https://geocoding-api.open-meteo.com/v1/search"
-        geocoding_params = {"name": city, "count": 1, "language": "en", "format": "json"}
-        
-        geo_response = requests.get(geocoding_url, params=geocoding_params)
-        geo_response.raise_for_status() 
-        
-        geo_data = geo_response.json()
-        logger.info(f"Geocoding API response for '{city}': {geo_data}")
-
-        results = geo_data.get("results")
-        if not results:
-            logger.warning(f"Geocoding failed for city '{city}'. No 'results' key in response.")
-            return f"Could not find a location for '{city}'. Please provide a more specific name or check for typos."
-
-        location_data = results[0]
+        location_data = _geocode(city)
         lat = location_data["latitude"]
         lon = location_data["longitude"]
         location_name = location_data.get("name", city)
         location_country = location_data.get("country", "")
 
-        # --- STEP 2: Weather forecast (with Vercel-compatible caching) ---
-        # --- THE FIX IS HERE ---
-        # We tell requests_cache to store its database in the only writable directory on Vercel: /tmp
-        cache_session = requests_cache.CachedSession('/tmp/weather_cache', expire_after=3600)
-        retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-        openmeteo = openmeteo_requests.Client(session=retry_session)
-
+        # --- STEP 2: Weather forecast (with in-memory caching) ---
         url = "https://api.open-meteo.com/v1/forecast"
         params = {
             "latitude": lat,
             "longitude": lon,
             "current": ["temperature_2m", "apparent_temperature", "precipitation", "wind_speed_10m"]
         }
-        responses = openmeteo.weather_api(url, params=params)
+        responses = _openmeteo().weather_api(url, params=params)
         response = responses[0]
         current = response.Current()
         
@@ -90,52 +227,42 @@ def get_weather(city: str) -> str:
                 f"Precipitation: {current.Variables(2).Value():.2f}mm "
                 f"Wind Speed: {current.Variables(3).Value():.2f}km/h")
 
+    except ToolError:
+        raise
     except requests.exceptions.HTTPError as e:
         logger.error(f"Geocoding HTTP error for city '{city}': {e.response.text}")
-        return f"There was a network problem finding the city '{city}'."
+        raise ToolError(f"There was a network problem finding the city '{city}'.") from e
     except Exception as e:
         logger.error(f"Weather API error: {e}", exc_info=True)
-        return f"An unexpected error occurred while fetching weather for '{city}'."
+        raise ToolError(f"An unexpected error occurred while fetching weather for '{city}'.") from e
 
 def get_stock_price(ticker_symbol: str) -> str:
     """Gets the latest stock price for a company using its stock ticker symbol."""
     try:
-        api_key = os.getenv("ALPHA_VANTAGE_API_KEY")
-        if not api_key:
-            return "Error: ALPHA_VANTAGE_API_KEY is not set."
-
-        ts = TimeSeries(key=api_key, output_format='json')
-        data, meta_data = ts.get_quote_endpoint(symbol=ticker_symbol)
-        
-        logger.info(f"Alpha Vantage raw data for {ticker_symbol}: {data}")
-
-        if not data:
-            return f"No data returned from the stock API for '{ticker_symbol}'. This could be due to an invalid ticker or API rate limits."
-
-        price = data.get('05. price')
-        if not price:
-            error_note = data.get('Note')
-            if error_note:
-                return f"Stock API error for '{ticker_symbol}': {error_note}"
-            return f"Could not find the price in the API response for '{ticker_symbol}'."
+        if not _AV_KEY:
+            raise ToolError("Error: ALPHA_VANTAGE_API_KEY is not set.")
 
+        price = _fetch_quote(ticker_symbol)['05. price']
         return f"The latest stock price for {ticker_symbol} is ${float(price):.2f}."
     
+    except ToolError:
+        raise
     except Exception as e:
         logger.error(f"Stock price error for {ticker_symbol}: {e}", exc_info=True)
-        return f"Error fetching stock price: {str(e)}"
+        raise ToolError(f"Error fetching stock price: {str(e)}") from e
 
 def get_wikipedia_summary(search_term: str) -> str:
     """Retrieves a concise summary of a topic from Wikipedia."""
+    import wikipedia
+
     try:
-        summary = wikipedia.summary(search_term, sentences=2, auto_suggest=False)
-        return summary
-    except wikipedia.exceptions.PageError:
-        return f"Sorry, I couldn't find a Wikipedia page for '{search_term}'."
+        return _fetch_summary(search_term)
+    except wikipedia.exceptions.PageError as e:
+        raise ToolError(f"Sorry, I couldn't find a Wikipedia page for '{search_term}'.") from e
     except wikipedia.exceptions.DisambiguationError as e:
-        return f"'{search_term}' is ambiguous. Please be more specific. Options might include: {e.options[:3]}"
+        raise ToolError(f"'{search_term}' is ambiguous. Please be more specific. Options might include: {e.options[:3]}") from e
     except Exception as e:
         logger.error(f"Wikipedia error: {e}")
-        return f"An error occurred while searching Wikipedia: {str(e)}"
+        raise ToolError(f"An error occurred while searching Wikipedia: {str(e)}") from e
 
 